@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import numpy as np # type: ignore
 import pandas as pd # type: ignore
-from itertools import combinations_with_replacement
 import re
 import os
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# Numeric value following 'CYP2D6*' in a haplotype name
+NUMERIC_VALUE_PATTERN = re.compile(r'\*([0-9]+)')
 
 def process_tsv_and_vcf(tsv_dir, vcf_dir, output_path):
     """
@@ -26,45 +31,70 @@ def process_tsv_and_vcf(tsv_dir, vcf_dir, output_path):
     tsv_path = os.path.join(tsv_dir, tsv_file)
 
     # Load the TSV file and adjust header
-    tsv_data = pd.read_csv(tsv_path, sep="\t", skiprows=1, header=0)
+    tsv_data = pd.read_csv(
+        tsv_path, sep="\t", skiprows=1, header=0,
+        dtype={"Variant Start": "Int64", "Variant Stop": "Int64"},
+        na_values={"Variant Start": ".", "Variant Stop": "."}
+    )
 
     # Ensure Variant Start and Variant Stop are integers
-    tsv_data["Variant Start"] = pd.to_numeric(tsv_data["Variant Start"], errors="coerce").fillna(0).astype(int)
-    tsv_data["Variant Stop"] = pd.to_numeric(tsv_data["Variant Stop"], errors="coerce").fillna(0).astype(int)
+    position_columns = ["Variant Start", "Variant Stop"]
+    tsv_data[position_columns] = tsv_data[position_columns].fillna(0).astype(np.int32)
 
     # Filter rows containing 'insertion' or 'deletion'
     filtered_data = tsv_data[tsv_data["Type"].str.contains("insertion|deletion", case=False, na=False)]
 
-    # Process each VCF file one by one
-    for vcf_file in os.listdir(vcf_dir):
-        if vcf_file.endswith(".vcf"):
-            vcf_path = os.path.join(vcf_dir, vcf_file)
-
-            with open(vcf_path, "r") as vcf:
-                for line in vcf:
-                    if line.startswith("#"):  # Skip header lines
-                        continue
-                    fields = line.strip().split("\t")
-                    pos, ref, alt = int(fields[1]), fields[3], fields[4]
-
-                    # Check if the POS matches any in the TSV file
-                    for index, row in filtered_data.iterrows():
-                        variant_start = row["Variant Start"]
-
-                        # Adjust comparison for deletion
-                        if "deletion" in row["Type"].lower():
-                            match_pos = pos + 1
-                        else:
-                            match_pos = pos
-
-                        if variant_start == match_pos:  # Match based on POS
-                            # Update Variant Allele and Alternate Allele for insertion/deletion
-                            tsv_data.at[index, "Reference Allele"] = ref
-                            tsv_data.at[index, "Variant Allele"] = alt
+    # Adjust comparison for deletion: the VCF POS is one base before the Variant Start
+    is_deletion = filtered_data["Type"].str.contains("deletion", case=False)
+    match_pos = filtered_data["Variant Start"] - is_deletion.astype(int)
+
+    # Map each VCF position to the rows it updates
+    rows_by_pos = {}
+    for index, pos in match_pos.items():
+        rows_by_pos.setdefault(pos, []).append(index)
+
+    # Parse the VCF files in parallel, the updates are returned in file order
+    vcf_paths = [os.path.join(vcf_dir, vcf_file) for vcf_file in os.listdir(vcf_dir) if vcf_file.endswith(".vcf")]
+    with ProcessPoolExecutor() as executor:
+        vcf_updates = list(executor.map(parse_vcf_updates, vcf_paths, repeat(rows_by_pos), chunksize=16))
+
+    # If several VCF records match, the last one read wins
+    updates = {index: (ref, alt) for file_updates in vcf_updates for index, ref, alt in file_updates}
+
+    if updates:
+        # Update Variant Allele and Alternate Allele for insertion/deletion, one block write per column
+        rows = list(updates)
+        refs, alts = zip(*updates.values())
+        tsv_data.loc[rows, "Reference Allele"] = refs
+        tsv_data.loc[rows, "Variant Allele"] = alts
 
     # Save the updated TSV data to a new file
     tsv_data.to_csv(output_path, sep="\t", index=False)
 
+def parse_vcf_updates(vcf_path, rows_by_pos):
+    """
+    Find the TSV rows matching the records of a single VCF file.
+
+    Args:
+        vcf_path (str): Path to the VCF file.
+        rows_by_pos (dict): VCF position mapped to the insertion/deletion rows of the TSV file it updates.
+
+    Returns:
+        list: (index, REF, ALT) tuple for each match, in the order of the VCF records.
+    """
+    # Read POS, REF and ALT of the VCF file
+    vcf_data = pd.read_csv(
+        vcf_path, sep="\t", comment="#", header=None, usecols=[1, 3, 4],
+        names=["POS", "REF", "ALT"], dtype={"REF": str, "ALT": str}, keep_default_na=False
+    )
+
+    # Match based on POS
+    return [
+        (index, ref, alt)
+        for pos, ref, alt in zip(vcf_data["POS"], vcf_data["REF"], vcf_data["ALT"])
+        for index in rows_by_pos.get(pos, ())
+    ]
+
 def filter_for_rsnumbers(pharmvardata, specific_rsIds):
     """
     Filter PharmVar data to include only the specified rsIDs and ensure haplotypes 
@@ -75,17 +105,18 @@ def filter_for_rsnumbers(pharmvardata, specific_rsIds):
         specific_rsIds (list): List of specific rsIDs to filter.
 
     Returns:
-        dict: Filtered haplotype data as a dictionary, with main haplotypes prioritized.
+        DataFrame: Filtered haplotype data with one row per haplotype (index) and one column
+            per rsID, with main haplotypes prioritized.
     """
     # Pre-filter the data to include only relevant rsIDs
     filtered_data = pharmvardata[pharmvardata['rsID'].isin(specific_rsIds)]
+    rs_columns = list(dict.fromkeys(specific_rsIds))
 
-    # Convert Reference names and Variant names into dictionaries for fast lookups
-    reference_dict = filtered_data.set_index('rsID')['Reference Allele'].to_dict()
-    variant_dict = filtered_data.set_index(['Haplotype Name', 'rsID'])['Variant Allele'].to_dict()
-
-    # Initialize the haplotype data structure
-    haplotype_data = {}
+    # Reference names per rsID and variant names per haplotype and rsID
+    reference_names = filtered_data.drop_duplicates('rsID', keep='last').set_index('rsID')['Reference Allele']
+    variant_names = filtered_data.drop_duplicates(['Haplotype Name', 'rsID'], keep='last').pivot(
+        index='Haplotype Name', columns='rsID', values='Variant Allele'
+    )
     haplotypes = list(filtered_data['Haplotype Name'].unique())
 
     # Filter PharmVar for the specific rsIds and include *1 and *5
@@ -93,106 +124,86 @@ def filter_for_rsnumbers(pharmvardata, specific_rsIds):
     # 'CYP2D6*5' is not in the pharmvar tsv data, because it is a gene deletion. 
     # It will be available for analysis with CNV = 0 later on.
     # Filter PharmVar for the specific rsIds and include *1 and *5
-    required_haplotypes = ['CYP2D6*5', 'CYP2D6*1']
-    for haplotype in required_haplotypes:
-        if haplotype not in haplotypes:
-            haplotypes.insert(0, haplotype)  # Add missing haplotypes at the beginning
-
-    # Iterate over each haplotype and rsID
-    for haplotype_name in haplotypes:
-        haplotype_data[haplotype_name] = {}
-        for rsID in specific_rsIds:
-            # Check for the variant value_name; if not found, use the reference value_name
-            variant_name = variant_dict.get((haplotype_name, rsID))
-            reference_name = reference_dict.get(rsID, '-')
-            haplotype_data[haplotype_name][rsID] = variant_name if variant_name is not None else reference_name
+    required_haplotypes = ['CYP2D6*1', 'CYP2D6*5']
+    haplotypes_set = set(haplotypes)
+    missing_haplotypes = [haplotype for haplotype in required_haplotypes if haplotype not in haplotypes_set]
+    haplotypes = missing_haplotypes + haplotypes  # Add missing haplotypes at the beginning
+
+    # Use the variant value_name of each haplotype and rsID; if not found, use the reference value_name
+    haplotype_data = variant_names.reindex(index=haplotypes, columns=rs_columns).astype(object)
+    haplotype_data = haplotype_data.fillna(reference_names.reindex(rs_columns).fillna('-'))
+    haplotype_data.index.name = None
+    haplotype_data.columns.name = None
 
     # check if a subvariant is equal to the main variant, if yes, remove the subvariant
-    for haplotype_name in list(haplotype_data.keys()):
-    # Check if the haplotype value_name has a subvariant (contains a '.')
-        if '.' in haplotype_name:
-            # Extract the main variant value_name (everything before the first '.')
-            main_variant = haplotype_name.split('.')[0]
-
-            # Check if the main variant exists in haplotype_data
-            if main_variant in haplotype_data:
-                # Compare the key-value pairs of the main variant and the subvariant
-                if haplotype_data[haplotype_name] == haplotype_data[main_variant]:
-                    # If identical, remove the subvariant
-                    del haplotype_data[haplotype_name]
+    # The main variant value_name is everything before the first '.' of a subvariant
+    main_variants = haplotype_data.index.str.split('.').str[0]
+    subvariants = haplotype_data.index.str.contains('.', regex=False) & main_variants.isin(haplotype_data.index)
+    identical = (
+        haplotype_data[subvariants].to_numpy() == haplotype_data.loc[main_variants[subvariants]].to_numpy()
+    ).all(axis=1)
+    redundant = haplotype_data.index[subvariants][identical]
 
-    return haplotype_data
+    return haplotype_data.drop(index=redundant)
 
 def special_combinations(haplotype_data, special_combinations, specific_rsIds):
     """
     Generate combined haplotypes for special combinations and update the haplotype data.
 
     Args:
-        haplotype_data (dict): Dictionary containing haplotype data.
+        haplotype_data (DataFrame): DataFrame containing haplotype data.
         special_combinations (set): Set of tuples defining special haplotype combinations.
         specific_rsIds (list): List of specific rsIDs to process.
 
     Returns:
-        dict: Updated haplotype data including special combinations.
+        DataFrame: Updated haplotype data including special combinations.
     """
+    rs_columns = list(dict.fromkeys(specific_rsIds))
+    combined_rows = {}
+
     # Iterate over each special combination
     for combination in special_combinations:
         combined_name = "+".join(combination)  # Create a combined haplotype value_name
-        haplotype_data[combined_name] = {}    # Add new combined haplotype
-
-        # Process each rsID in the specific list
-        for rsID in specific_rsIds:
-            # Collect names for this rsID from the parts of the combination
-            names = [
-                haplotype_data[part][rsID]
-                for part in combination
-                if part in haplotype_data and rsID in haplotype_data[part]
-            ]
-
-            # Determine the resulting value_name for the combination
-            if not names:  # No names found
-                name_value = '-'
-            elif len(set(names)) == 1:  # All names are the same
-                name_value = names[0]
-            else:  # Combine differing names with "/"
-                name_value = '/'.join(sorted(set(names)))
-
-            # Update haplotype_data directly
-            haplotype_data[combined_name][rsID] = name_value
 
-    return haplotype_data
+        # Collect names for each rsID from the parts of the combination
+        parts = haplotype_data.loc[[part for part in combination if part in haplotype_data.index], rs_columns]
+        if parts.empty:  # No names found
+            combined_rows[combined_name] = ['-'] * len(rs_columns)
+            continue
+
+        # Determine the resulting value_name for the combination
+        combined_rows[combined_name] = [
+            names[0] if len(set(names)) == 1  # All names are the same
+            else '/'.join(sorted(set(names)))  # Combine differing names with "/"
+            for names in parts.to_numpy().T.tolist()
+        ]
+
+    # Add the new combined haplotypes
+    combined_data = pd.DataFrame.from_dict(combined_rows, orient='index', columns=rs_columns, dtype=object)
+    return pd.concat([haplotype_data, combined_data])
 
 def add_cnv_values_ex9(haplotype_data, cnv_exceptions, special_combinations_cnv):
     """
     Add CNV values analysed in exon 9 to haplotypes, taking into account exceptions and special combinations.
 
     Args:
-        haplotype_data (dict): Dictionary containing haplotype data.
+        haplotype_data (DataFrame): DataFrame containing haplotype data.
         cnv_exceptions (list): List of haplotypes with CNV set to 0.
         special_combinations_cnv (dict): Dictionary of special CNV combinations with predefined values.
 
     Returns:
-        dict: Updated haplotype data with CNV values assigned.
+        DataFrame: Updated haplotype data with CNV values assigned.
     """
-    # Add the CNV column to the haplotype_data dictionary
-    for haplotype_name in haplotype_data:
-        # Default CNV value is set to 1 for each haplotype
-        cnv_value = 1
-
-        # Check if the haplotype is in the exceptions list and set CNV to 0 if it is
-        if haplotype_name in cnv_exceptions:
-            cnv_value = 0
-
-        # Assign the CNV value to the current haplotype
-        haplotype_data[haplotype_name]["CNV"] = cnv_value
+    # Default CNV value is set to 1 for each haplotype
+    haplotype_data["CNV"] = 1
 
-        # If the haplotype is part of a special combination, use the predefined CNV value
-        if haplotype_name in special_combinations_cnv:
-            # Use the predefined CNV value for the special combination
-            cnv_value = special_combinations_cnv[haplotype_name]
+    # Set CNV to 0 for the haplotypes in the exceptions list
+    haplotype_data.loc[haplotype_data.index.isin(cnv_exceptions), "CNV"] = 0
 
-            # Set the CNV value for the special combination
-            haplotype_data[haplotype_name]["CNV"] = cnv_value
+    # If the haplotype is part of a special combination, use the predefined CNV value
+    special_cnv = haplotype_data.index.map(special_combinations_cnv)
+    has_special_cnv = special_cnv.notna()
+    haplotype_data.loc[has_special_cnv, "CNV"] = special_cnv[has_special_cnv].astype(int)
 
     return haplotype_data
 
@@ -201,60 +212,48 @@ def cnv_variations(haplotype_data, cnv_duplications, cnv_triplication):
     Create CNV duplications and triplications for specified haplotypes.
 
     Args:
-        haplotype_data (dict): Dictionary containing haplotype data.
+        haplotype_data (DataFrame): DataFrame containing haplotype data.
         CNV_DEFINITIONS_2 (list): List of haplotypes of gene duplication to get CNV = 2.
         CNV_DEFINITIONS_3 (list): List of haplotypes of gene triplication to get CNV = 3.
 
     Returns:
-        dict: Updated haplotype data including CNV duplications and triplications.
+        DataFrame: Updated haplotype data including CNV duplications and triplications.
     """
-    # Duplicate haplotypes for CNV = 2
-    for haplotype_name in cnv_duplications:
-        if haplotype_name in haplotype_data:
-            duplicated_entry = haplotype_data[haplotype_name].copy()
-            duplicated_entry["CNV"] = 2
-            haplotype_data[f"{haplotype_name}x2"] = duplicated_entry
-
-    # Duplicate haplotypes for CNV = 3
-    for haplotype_name in cnv_triplication:
-        if haplotype_name in haplotype_data:
-            duplicated_entry = haplotype_data[haplotype_name].copy()
-            duplicated_entry["CNV"] = 3
-            haplotype_data[f"{haplotype_name}x3"] = duplicated_entry
+    multiplications = [haplotype_data]
 
-    return haplotype_data
+    # Duplicate haplotypes for CNV = 2 and CNV = 3
+    for haplotype_names, cnv_value in [(cnv_duplications, 2), (cnv_triplication, 3)]:
+        names = [name for name in dict.fromkeys(haplotype_names) if name in haplotype_data.index]
+        duplicated_entries = haplotype_data.loc[names].copy()
+        duplicated_entries["CNV"] = cnv_value
+        duplicated_entries.index = duplicated_entries.index + f"x{cnv_value}"
+        multiplications.append(duplicated_entries)
+
+    return pd.concat(multiplications)
 
 def add_ranking(haplotype_data, ranking):
     """
     Assign ranking values (Value: 0, 1, or 2) to haplotypes based on predefined criteria.
 
     Args:
-        haplotype_data (dict): Dictionary containing haplotype data.
+        haplotype_data (DataFrame): DataFrame containing haplotype data.
         ranking (dict): Dictionary defining 'Top Tier' and '2nd Tier' haplotypes.
 
     Returns:
-        dict: Updated haplotype data with ranking values assigned.
+        DataFrame: Updated haplotype data with ranking values assigned.
     """
-    # Create a dictionary to store the Tier values
-    tier_dict = {}
-
-    for haplotype_name in haplotype_data.keys():
-        if haplotype_name in ranking.get('Top Tier', []):
-            tier_dict[haplotype_name] = 2
-        elif haplotype_name.endswith("x2"):
-            tier_dict[haplotype_name] = 2
-        elif haplotype_name.endswith("x3"):
-            tier_dict[haplotype_name] = 2
-        elif haplotype_name in ranking.get('2nd Tier', []):
-            tier_dict[haplotype_name] = 1
-        elif '+' in haplotype_name:
-            tier_dict[haplotype_name] = 1
-        else:
-            tier_dict[haplotype_name] = 0
-
-    # Update the haplotype_data dictionary with the assigned Tier values
-    for haplotype_name in haplotype_data:
-        haplotype_data[haplotype_name]["Ranking"] = tier_dict.get(haplotype_name, 0)
+    # Tier values, the first matching criterion decides
+    haplotype_names = haplotype_data.index
+    criteria = [
+        (haplotype_names.isin(ranking.get('Top Tier', [])), 2),
+        (haplotype_names.str.endswith("x2"), 2),
+        (haplotype_names.str.endswith("x3"), 2),
+        (haplotype_names.isin(ranking.get('2nd Tier', [])), 1),
+        (haplotype_names.str.contains('+', regex=False), 1),
+    ]
+
+    # Update the haplotype_data with the assigned Tier values
+    haplotype_data["Ranking"] = np.select([mask for mask, _ in criteria], [tier for _, tier in criteria], default=0)
 
     return haplotype_data
 
@@ -268,7 +267,7 @@ def extract_numeric_value(haplotype_name):
     Returns:
         int: Extracted numeric value. Returns 0 if no numeric value is found.
     """
-    match = re.search(r'\*([0-9]+)', haplotype_name)
+    match = NUMERIC_VALUE_PATTERN.search(haplotype_name)
     return int(match.group(1)) if match else 0
 
 def pair_haplotypes(haplotype_data):
@@ -277,60 +276,50 @@ def pair_haplotypes(haplotype_data):
     CNV, Ranking, and rsID values.
 
     Args:
-        haplotype_data (dict): Dictionary containing haplotype data.
+        haplotype_data (DataFrame): DataFrame containing haplotype data.
 
     Returns:
-        dict: New dictionary with paired haplotypes and their combined values.
+        DataFrame: Pandas DataFrame with the paired haplotypes in the 'Genotype' column
+            and their combined values.
     """
-    # List of all unique haplotypes
-    haplotypes_list = list(haplotype_data.keys())
-
-    # Dictionary to store the combined results
-    combinations_dict = {}
-
-    # Iterate over all combinations (including self-pairing)
-    for haplotype1, haplotype2 in combinations_with_replacement(haplotypes_list, 2):
-        # Sort numerically based on the number after 'CYP2D6'
-        sorted_haplotypes = sorted([haplotype1, haplotype2], key=extract_numeric_value)
-        combined_key = f"{sorted_haplotypes[0]}/{sorted_haplotypes[1]}"
-
-        if combined_key not in combinations_dict:
-            combinations_dict[combined_key] = {}
-
-        # Process each attribute (rs values, CNV, Ranking)
-        for value_name in set(haplotype_data[haplotype1].keys()).union(haplotype_data[haplotype2].keys()):
-            value1 = haplotype_data[haplotype1].get(value_name)
-            value2 = haplotype_data[haplotype2].get(value_name)
-
-            # Special handling for CNV and Ranking
-            if value_name in ["CNV", "Ranking"]:
-                combined_value = value1 + value2
-            else:
-                combined_value = value1 if value1 == value2 else f"{value1}/{value2}"
-
-            # Store the combined value
-            combinations_dict[combined_key][value_name] = combined_value
-
-    return combinations_dict
-
-def combinations_dict_to_dataframe(combinations_dict):
-    """
-    Convert a dictionary of haplotype combinations into a Pandas DataFrame.
-
-    Args:
-        combinations_dict (dict): Dictionary of haplotype combinations with combined values.
-
-    Returns:
-        DataFrame: Pandas DataFrame with haplotype combinations and associated values.
-    """
-    # Convert dictionary to DataFrame
-    dataframe = pd.DataFrame.from_dict(combinations_dict, orient='index')
-
-    # Reset index to make combined keys a column
-    dataframe.reset_index(inplace=True)
-    dataframe.rename(columns={'index': 'Genotype'}, inplace=True)
-
-    return dataframe
+    # List of all unique haplotypes and the numeric value used to sort them
+    haplotypes_list = list(haplotype_data.index)
+    numeric_values = np.array([extract_numeric_value(haplotype) for haplotype in haplotypes_list])
+
+    # Collect the values of all haplotypes in arrays, one row per haplotype
+    # CNV and Ranking are added up, all other values (rs values) are combined as strings
+    count_names = [name for name in haplotype_data.columns if name in ["CNV", "Ranking"]]
+    rs_names = [name for name in haplotype_data.columns if name not in count_names]
+    rs_values = haplotype_data[rs_names].to_numpy(dtype=object)
+    count_values = haplotype_data[count_names].to_numpy()
+
+    # Encode every distinct rs value as an integer code
+    rs_strings, rs_codes = np.unique(rs_values, return_inverse=True)
+    rs_codes = rs_codes.reshape(rs_values.shape)
+
+    # Index pairs of all combinations (including self-pairing), in the order of combinations_with_replacement
+    first, second = np.triu_indices(len(haplotypes_list))
+
+    # Table of the combined value for each pair of codes: equal values are kept, differing values are joined with '/'
+    value1, value2 = rs_strings[:, np.newaxis], rs_strings[np.newaxis, :]
+    pair_table = np.where(value1 == value2, value1, value1 + "/" + value2)
+
+    # Look up the combined rs values and add up CNV and Ranking of both haplotypes
+    combined_rs_values = pair_table[rs_codes[first], rs_codes[second]]
+    combined_counts = count_values[first] + count_values[second]
+
+    # Sort numerically based on the number after 'CYP2D6', swapping a pair only if the second number is lower
+    swapped = numeric_values[second] < numeric_values[first]
+    lower, higher = np.where(swapped, second, first), np.where(swapped, first, second)
+    haplotype_names = np.array(haplotypes_list, dtype=object)
+    genotypes = haplotype_names[lower] + "/" + haplotype_names[higher]
+
+    # Wrap the columns into a DataFrame, the few distinct rs values per column are stored as categories
+    return pd.DataFrame({
+        'Genotype': genotypes,
+        **{name: pd.Categorical(values) for name, values in zip(rs_names, combined_rs_values.T)},
+        **dict(zip(count_names, combined_counts.T))
+    })
 
 def save_dataframe_to_pickle(dataframe, save_directory):
     """
@@ -451,11 +440,8 @@ def main():
     } # Multiplications are also 'Top Tier', hybrid genes are '2nd Tier'.
     haplotypes_dic = add_ranking(data_with_cnv, ranking)
 
-    # Pair each haplotype
-    combinations = pair_haplotypes(haplotypes_dic)
-
-    # Convert dict to pandaframe
-    pf_combinations = combinations_dict_to_dataframe(combinations)
+    # Pair each haplotype into a pandaframe
+    pf_combinations = pair_haplotypes(haplotypes_dic)
     # print(pf_combinations)
 
     # Save dataframe to pkl
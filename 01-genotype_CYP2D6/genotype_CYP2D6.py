@@ -1,13 +1,55 @@
 #!/usr/bin/env python3
 
 import os
-import io
 import re
+import sys
+import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
 import shutil
 import glob
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-def read_vcf_and_move(input_path, destination_path):
+# Column names of the diplotypes DataFrame that are rsIDs
+RS_ID_PATTERN = re.compile(r'^rs\d+$')
+
+# Translation table turning phased GT separators into unphased ones
+GT_SEPARATOR_TABLE = str.maketrans('|', '/')
+
+# Every "CYP2D6*" prefix of a genotype except the leading one
+REPEATED_PREFIX_PATTERN = re.compile(r'(?!^)\bCYP2D6\*')
+
+@lru_cache(maxsize=4)
+def rs_id_columns(columns):
+    """
+    Select the rsID columns of a diplotypes DataFrame, cached per column layout.
+
+    Args:
+        columns (tuple): Column names of the diplotypes DataFrame.
+
+    Returns:
+        tuple: The rsID column names, in their original order.
+    """
+    return tuple(col for col in columns if col.startswith('rs') and RS_ID_PATTERN.match(col))
+
+def move_file(source_path, destination_path):
+    """
+    Move a file with a single rename, falling back to shutil.move across filesystems.
+
+    Args:
+        source_path (str): Path of the file to move.
+        destination_path (str): Path to move the file to.
+
+    Returns:
+        None
+    """
+    try:
+        os.rename(source_path, destination_path)
+    except OSError:
+        shutil.move(source_path, destination_path)
+
+def read_vcf_and_move(input_path, destination_path, vcf_file_name=None):
     """
     Reads a VCF file from the given input path, returns its contents as a Pandas DataFrame,
     and moves the file to a specified destination path.
@@ -16,6 +58,7 @@ def read_vcf_and_move(input_path, destination_path):
     Args:
         input_path (str): Path to the directory containing the VCF file.
         destination_path (str): Path to move the VCF file after reading.
+        vcf_file_name (str, optional): Filename of the VCF file. Defaults to the first .vcf file in input_path.
 
     Returns:
         tuple: A tuple containing:
@@ -23,34 +66,42 @@ def read_vcf_and_move(input_path, destination_path):
             - str: The filename of the VCF file.
     """
     # Find the first .vcf file in the input path
-    vcf_files = [file for file in os.listdir(input_path) if file.endswith('.vcf')]
-    if not vcf_files:
-        raise FileNotFoundError("No .vcf files found in the provided directory.")
-    
-    # Get the full file path and filename
-    vcf_file_path = os.path.join(input_path, vcf_files[0])
-    vcf_file_name = vcf_files[0]
+    if vcf_file_name is None:
+        vcf_files = [file for file in os.listdir(input_path) if file.endswith('.vcf')]
+        if not vcf_files:
+            raise FileNotFoundError("No .vcf files found in the provided directory.")
+        vcf_file_name = vcf_files[0]
     
-    # Read the .vcf file
-    with open(vcf_file_path, 'r') as f:
-        lines = [l for l in f if not l.startswith('##')]
+    # Get the full file path
+    vcf_file_path = os.path.join(input_path, vcf_file_name)
     
-    # Load the data into a Pandas DataFrame
-    vcf_data = pd.read_csv(
-        io.StringIO(''.join(lines)),
-        dtype={
-            '#CHROM': str, 'POS': int, 'ID': str, 'REF': str, 'ALT': str,
-            'QUAL': str, 'FILTER': str, 'INFO': str
-        },
-        sep='\t'
-    ).rename(columns={'#CHROM': 'CHROM'})
+    # Read the .vcf file, starting right after the metadata lines
+    with open(vcf_file_path, 'rb') as f:
+        header_end = 0
+        line = f.readline()
+        while line.startswith(b'##'):
+            header_end = f.tell()
+            line = f.readline()
+        f.seek(header_end)
+
+        # Keep CHROM to ALT, FORMAT and the first sample column, skipping QUAL, FILTER and INFO
+        header = line.decode().rstrip('\r\n').split('\t')
+        used_columns = header[:5] + header[8:10]
+
+        # Load the data into a Pandas DataFrame
+        vcf_data = pd.read_csv(
+            f,
+            usecols=used_columns,
+            dtype={'#CHROM': str, 'POS': int, 'ID': 'category', 'REF': str, 'ALT': str},
+            sep='\t'
+        ).rename(columns={'#CHROM': 'CHROM'})
     
     # Ensure the destination path exists
     os.makedirs(destination_path, exist_ok=True)
     
     # Move the file to the destination path
     destination_file_path = os.path.join(destination_path, vcf_file_name)
-    shutil.move(vcf_file_path, destination_file_path)
+    move_file(vcf_file_path, destination_file_path)
     
     return vcf_data, vcf_file_name
 
@@ -69,69 +120,147 @@ def extract_rs_genotypes(diplotypes_df, vcf_df):
     genotypes = {}
 
     # Step 1: Extract rsIDs from diplotypes_df
-    rs_pattern = re.compile(r'^rs\d+$')
-    valid_rsids = [col for col in diplotypes_df.columns if rs_pattern.match(col)]
-
-    # Step 2: Extract genotypes from VCF DataFrame only for valid rsIDs
-    for _, row in vcf_df.iterrows():
-        if pd.notna(row['ID']) and row['ID'] in valid_rsids:  # Check if rsID is valid
-            try:
-                # Locate GT (genotype) field position in FORMAT
-                format_fields = row['FORMAT'].split(':')
-                gt_index = format_fields.index('GT')  # Find position of GT
-                
-                # Extract genotype from the first sample column (10th column)
-                sample_data = row.iloc[9]  # Assuming first sample column
-                sample_fields = sample_data.split(':')
-                gt_value = sample_fields[gt_index]
-                
-                # Convert GT (e.g., '0/1') to allele letters
-                alleles = [row['REF']] + row['ALT'].split(',')
-                genotype = '/'.join([alleles[int(i)] for i in gt_value.replace('|', '/').split('/') if i.isdigit()])
-                
-                # Add to dictionary
-                genotypes[row['ID']] = genotype
-            except (IndexError, ValueError) as e:
-                print(f"Error processing row {row['ID']}: {e}")
-                continue
-    
+    valid_rsids = frozenset(rs_id_columns(tuple(diplotypes_df.columns)))
+
+    # Step 2: Keep only the VCF rows of valid rsIDs
+    rs_rows = vcf_df[vcf_df['ID'].isin(valid_rsids)]
+    if rs_rows.empty:
+        return genotypes
+
+    # Step 3: Locate GT (genotype) field position once per distinct FORMAT
+    format_gt_index = {}
+    for format_value in rs_rows['FORMAT'].unique():
+        fields = str(format_value).split(':')
+        format_gt_index[format_value] = fields.index('GT') if 'GT' in fields else -1
+    gt_index = rs_rows['FORMAT'].map(format_gt_index)
+
+    # Step 4: Extract GT from the first sample column, which follows FORMAT
+    sample_column = rs_rows.columns.get_loc('FORMAT') + 1
+    if list(format_gt_index.values()) == [0]:
+        # Fast path: a single FORMAT with GT as its first field
+        gt_values = rs_rows.iloc[:, sample_column].str.split(':', n=1).str.get(0)
+    else:
+        # One lookup per GT position
+        sample_fields = rs_rows.iloc[:, sample_column].str.split(':')
+        gt_values = pd.Series(None, index=rs_rows.index, dtype=object)
+        for position in gt_index[gt_index >= 0].unique():
+            at_position = gt_index == position
+            gt_values[at_position] = sample_fields[at_position].str.get(position)
+
+    # Skip rows without a GT value
+    missing_gt = gt_values.isna()
+    for rsid in rs_rows.loc[missing_gt, 'ID']:
+        print(f"Error processing row {rsid}: no GT value found")
+    rs_rows, gt_values = rs_rows[~missing_gt], gt_values[~missing_gt]
+
+    # Step 5: Convert GT (e.g., '0/1') to allele letters
+    gt_allele_indices = gt_values.str.translate(GT_SEPARATOR_TABLE).str.split('/')
+    alleles = (rs_rows['REF'] + ',' + rs_rows['ALT']).str.split(',')
+    for rsid, allele_indices, row_alleles in zip(rs_rows['ID'], gt_allele_indices, alleles):
+        try:
+            genotypes[rsid] = '/'.join([row_alleles[int(i)] for i in allele_indices if i.isdigit()])
+        except IndexError as e:
+            print(f"Error processing row {rsid}: {e}")
+
     return genotypes
 
-def evaluate_matches(diplotypes_df, data_input):
+def index_diplotypes(diplotypes_df):
     """
-    Match user-provided genetic input against a diplotypes DataFrame.
+    Index the rows of the diplotypes DataFrame by the allele sets of all rsID columns and CNV,
+    so that samples can be matched without parsing the allele strings again.
 
     Args:
         diplotypes_df (pd.DataFrame): DataFrame containing SNPs and genotypes.
-        data_input (dict): Dictionary with SNP rsIDs as keys and allele values as strings.
 
     Returns:
-        list: Genotype names from the DataFrame that match the user input.
+        tuple: A tuple containing:
+            - dict: Allele sets (frozenset) mapped to an integer id.
+            - pd.DataFrame: The allele set id of every cell of the indexed columns.
+            - dict: Tuples of allele set ids, one per indexed column, mapped to the matching row positions.
     """
-    # Create an empty list for matches
-    matches = []
+    columns = list(rs_id_columns(tuple(diplotypes_df.columns))) + ['CNV']
 
-    # Convert data_input into a DataFrame
-    user_df = pd.DataFrame(data_input, index=[0])
+    # Give each allele set an id, once per distinct value of a column
+    allele_set_ids = {}
+    row_ids = np.empty((len(diplotypes_df), len(columns)), dtype=np.int64)
+    for k, column in enumerate(columns):
+        value_codes, values = pd.factorize(diplotypes_df[column], use_na_sentinel=False)
+        value_ids = [allele_set_ids.setdefault(frozenset(str(v).split('/')), len(allele_set_ids)) for v in values]
+        row_ids[:, k] = np.array(value_ids, dtype=np.int64)[value_codes]
 
-    for i, row in diplotypes_df.iterrows():
-        try:
-            # Check if all alleles match for the SNPs present in both user inputs and the DataFrame
-            allele_match = all([
-                set(user_df.loc[0, rsID].split('/')) == set(str(row[rsID]).split('/'))
-                for rsID in data_input.keys()  # Check only keys in data_input
-                if rsID in row.index  # Ensure rsID exists in the DataFrame
-            ])
+    # Store the ids in the narrowest unsigned type, a single byte for the current table
+    allele_set_frame = pd.DataFrame(row_ids.astype(np.min_scalar_type(len(allele_set_ids))), columns=columns)
+
+    # Group the row positions by their tuple of allele set ids
+    signatures = {}
+    for position, signature in enumerate(map(tuple, row_ids.tolist())):
+        signatures.setdefault(signature, []).append(position)
+
+    return allele_set_ids, allele_set_frame, signatures
+
+@lru_cache(maxsize=2)
+def load_diplotypes(pkl_file_path, modification_time):
+    """
+    Load the diplotypes DataFrame and index it, cached per file version.
+
+    Args:
+        pkl_file_path (str): Path to the .pkl file containing the diplotypes DataFrame.
+        modification_time (float): Modification time of the file, so that a rewritten file is loaded again.
 
-            # If there's a match, append the index or relevant column (e.g., 'Genotype') to the results
-            if allele_match:
-                matches.append(row['Genotype'])  # Add 'Genotype' to the match list
+    Returns:
+        tuple: A tuple containing:
+            - pd.DataFrame: The diplotypes DataFrame.
+            - tuple: Index of the DataFrame created by index_diplotypes.
+    """
+    diplotypes_df = pd.read_pickle(pkl_file_path)
+    return diplotypes_df, index_diplotypes(diplotypes_df)
 
-        except KeyError as e:
-            # Handle cases where the data_input have an SNP not in the DataFrame
-            print(f"KeyError: {e}. Check if all SNPs in data_input exist in the DataFrame.")
+def evaluate_matches(diplotypes_df, data_input, diplotype_index=None):
+    """
+    Match user-provided genetic input against a diplotypes DataFrame.
 
-    return matches
+    Args:
+        diplotypes_df (pd.DataFrame): DataFrame containing SNPs and genotypes.
+        data_input (dict): Dictionary with SNP rsIDs as keys and allele values as strings.
+        diplotype_index (tuple, optional): Index of diplotypes_df created by index_diplotypes.
+
+    Returns:
+        list: Genotype names from the DataFrame that match the user input.
+    """
+    # Normalize the user alleles of each SNP present in the DataFrame to a set
+    user_norm = {rsID: frozenset(value.split('/')) for rsID, value in data_input.items() if rsID in diplotypes_df.columns}
+
+    # Start with all rows matching
+    mask = np.ones(len(diplotypes_df), dtype=bool)
+    remaining = user_norm
+
+    if diplotype_index is not None:
+        allele_set_ids, allele_set_frame, signatures = diplotype_index
+
+        # Look up the matching rows directly if the input provides exactly the indexed columns
+        if user_norm.keys() == set(allele_set_frame.columns):
+            signature = tuple(allele_set_ids.get(user_norm[col], -1) for col in allele_set_frame.columns)
+            return diplotypes_df['Genotype'].iloc[signatures.get(signature, [])].tolist()
+
+        # Otherwise compare the precomputed allele set ids of all indexed SNPs at once
+        indexed = [rsID for rsID in user_norm if rsID in allele_set_frame.columns]
+        indexed_ids = allele_set_frame[indexed].to_numpy()
+        query_ids = [allele_set_ids.get(user_norm[rsID]) for rsID in indexed]
+        if None in query_ids:  # An allele set that no diplotype has
+            mask[:] = False
+        else:
+            mask &= (indexed_ids == np.array(query_ids, dtype=indexed_ids.dtype)).all(axis=1)
+        remaining = {rsID: alleles for rsID, alleles in user_norm.items() if rsID not in allele_set_frame.columns}
+
+    # Narrow down the remaining SNPs one at a time
+    for rsID, user_alleles in remaining.items():
+        # Compare the alleles as sets, once per distinct value of the column
+        column = diplotypes_df[rsID]
+        matching_values = [v for v in column.unique() if frozenset(str(v).split('/')) == user_alleles]
+        mask &= column.isin(matching_values).to_numpy()
+
+    # Return the 'Genotype' of all matching rows
+    return diplotypes_df.loc[mask, 'Genotype'].tolist()
 
 def print_matches(diplotypes_df, matches, output_path, vcf_filename):
     """
@@ -150,17 +279,13 @@ def print_matches(diplotypes_df, matches, output_path, vcf_filename):
     # Filter rows in diplotypes_df that match the Genotype in matches
     matches_df = diplotypes_df[diplotypes_df['Genotype'].isin(matches)]
 
-    # Sort the filtered DataFrame by Ranking in descending order
-    matches_sorted = matches_df.sort_values(by='Ranking', ascending=False)
-
-    # Process only the first match with Ranking and CNV values
-    if not matches_sorted.empty:
-        first_match = matches_sorted.iloc[0]
+    # Process only the highest ranked match, the first one on ties
+    if not matches_df.empty:
+        first_match = matches_df.loc[matches_df['Ranking'].idxmax()]
         genotype = first_match['Genotype']
 
-        # Adjust the genotype to remove redundant "CYP2D6" prefixes
-        adjusted_genotype = re.sub(r'\bCYP2D6\*', '*', genotype)  # Remove all "CYP2D6*"
-        adjusted_genotype = adjusted_genotype.replace('*', 'CYP2D6*', 1)  # Add back the first "CYP2D6*"
+        # Adjust the genotype to remove redundant "CYP2D6" prefixes, keeping the first one
+        adjusted_genotype = REPEATED_PREFIX_PATTERN.sub('*', genotype)
 
         # Create the output directory if it doesn't exist
         os.makedirs(output_path, exist_ok=True)
@@ -175,7 +300,7 @@ def print_matches(diplotypes_df, matches, output_path, vcf_filename):
 
         print(f"Genotype saved to: {output_file_path}")
     else:
-        print("No matches found.")
+        print(f"No matches found for {vcf_filename}.")
 
 # def print_all_matches(diplotypes_df, matches): # This function is not in use
 #     """
@@ -196,37 +321,28 @@ def print_matches(diplotypes_df, matches, output_path, vcf_filename):
 
 #     # Print the sorted matches with Ranking and CNV values
 #     # print("Matches nach Wahrscheinlichkeit absteigend sortiert:")
-#     for _, row in matches_sorted.iterrows():
-#         genotype = row['Genotype']
-#         ranking = row['Ranking']
-#         cnv_value = row['CNV']
-#         print(f"100% Match: {genotype}, Ranking: {ranking}, CNV-Wert: {cnv_value}")
+#     for row in matches_sorted.itertuples(index=False):
+#         print(f"100% Match: {row.Genotype}, Ranking: {row.Ranking}, CNV-Wert: {row.CNV}")
 
-def main():
-    """
-    Main function to execute the genotype matching pipeline:
-    1. Load the reference DataFrame containing diplotypes.
-    2. Load and process VCF data to extract genotypes.
-    3. Extract the CNV value from the VCF data.
-    4. Compare user-provided genotypes against the reference DataFrame.
-    5. Identify and rank matches based on likelihood and CNV values.
-    6. Print the results sorted by ranking and CNV values to a txt file.
+def genotype_sample(vcf_filename, diplotypes_df, diplotype_index):
     """
+    Genotype one sample: read its VCF and CNV files, match them against the diplotypes
+    and save the highest ranked genotype to a txt file.
 
-    # Step 1: Load the reference DataFrame containing diplotypes
-    directory_path = '../00-preprocessing_data/output/'
-    pkl_files = glob.glob(os.path.join(directory_path, "*.pkl"))
-    if not pkl_files:
-        raise FileNotFoundError("No .pkl files found in the provided directory.")
-    latest_pkl_file = max(pkl_files, key=os.path.getmtime)
-    diplotypes_df = pd.read_pickle(latest_pkl_file)
+    Args:
+        vcf_filename (str): Filename of the sample VCF file in the input folder.
+        diplotypes_df (pd.DataFrame): DataFrame containing SNPs and genotypes.
+        diplotype_index (tuple): Index of diplotypes_df created by index_diplotypes.
 
-    # Step 2: Load the VCF file with sample genotype data
+    Returns:
+        None
+    """
+    # Step 1: Load the VCF file with sample genotype data
     sample_filepath = './input'
     processed_filepath = './input/processed_data'
-    vcf_data, vcf_filename = read_vcf_and_move(sample_filepath, processed_filepath)
+    vcf_data, vcf_filename = read_vcf_and_move(sample_filepath, processed_filepath, vcf_filename)
 
-    # Step 3: Extract the CNV value from the VCF data
+    # Step 2: Extract the CNV value from the VCF data
     txt_filename = os.path.splitext(vcf_filename)[0] + '.txt'
     txt_file_path = os.path.join('./input', txt_filename)
     if os.path.exists(txt_file_path):
@@ -239,19 +355,78 @@ def main():
         CNV_value = data.get(key_to_extract)
 
     destination_file_path = os.path.join(processed_filepath, txt_filename)
-    shutil.move(txt_file_path, destination_file_path)
+    move_file(txt_file_path, destination_file_path)
 
-    # Step 4: Extract genotypes for specific rsIDs from the VCF data
+    # Step 3: Extract genotypes for specific rsIDs from the VCF data
     sample_data = extract_rs_genotypes(diplotypes_df, vcf_data)
     sample_data['CNV'] = CNV_value
 
-    # Step 5: Compare the extracted genotypes against the reference DataFrame
-    results = evaluate_matches(diplotypes_df, sample_data)
+    # Step 4: Compare the extracted genotypes against the reference DataFrame
+    results = evaluate_matches(diplotypes_df, sample_data, diplotype_index)
 
-    # Step 6: Print the matched genotypes sorted by ranking and CNV values
+    # Step 5: Print the matched genotypes sorted by ranking and CNV values
     output_path = './output'
     print_matches(diplotypes_df, results, output_path, vcf_filename)
 
+def try_genotype_sample(vcf_filename, diplotypes_df, diplotype_index):
+    """
+    Genotype one sample with genotype_sample, reporting an error instead of raising it
+    so that the other samples of a batch are still processed.
+
+    Args:
+        vcf_filename (str): Filename of the sample VCF file in the input folder.
+        diplotypes_df (pd.DataFrame): DataFrame containing SNPs and genotypes.
+        diplotype_index (tuple): Index of diplotypes_df created by index_diplotypes.
+
+    Returns:
+        bool: True if the sample was genotyped, False if it failed.
+    """
+    try:
+        genotype_sample(vcf_filename, diplotypes_df, diplotype_index)
+    except Exception as e:
+        print(f"Error processing sample {vcf_filename}: {type(e).__name__}: {e}")
+        return False
+    return True
+
+def main():
+    """
+    Main function to execute the genotype matching pipeline:
+    1. Load the reference DataFrame containing diplotypes.
+    2. Find the sample VCF files in the input folder.
+    3. Genotype each sample, in parallel when there are several and more than one CPU:
+       extract its genotypes and CNV value, compare them against the reference DataFrame,
+       and print the highest ranked match to a txt file.
+    """
+
+    # Step 1: Load the reference DataFrame containing diplotypes
+    directory_path = '../00-preprocessing_data/output/'
+    pkl_files = glob.glob(os.path.join(directory_path, "*.pkl"))
+    if not pkl_files:
+        raise FileNotFoundError("No .pkl files found in the provided directory.")
+    latest_pkl_file = max(pkl_files, key=os.path.getmtime)
+    diplotypes_df, diplotype_index = load_diplotypes(latest_pkl_file, os.path.getmtime(latest_pkl_file))
+
+    # Step 2: Find the VCF files with sample genotype data
+    vcf_filenames = sorted(file for file in os.listdir('./input') if file.endswith('.vcf'))
+    if not vcf_filenames:
+        raise FileNotFoundError("No .vcf files found in the provided directory.")
+
+    # Step 3: Genotype each sample, in-process unless several workers can run in parallel
+    max_workers = min(len(vcf_filenames), os.cpu_count() or 1)
+    if max_workers == 1:
+        succeeded = [try_genotype_sample(vcf_filename, diplotypes_df, diplotype_index) for vcf_filename in vcf_filenames]
+    else:
+        # Send the reference data once per worker
+        chunksize = -(-len(vcf_filenames) // max_workers)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            succeeded = list(executor.map(try_genotype_sample, vcf_filenames, repeat(diplotypes_df), repeat(diplotype_index), chunksize=chunksize))
+
+    # Exit with an error status if any sample failed
+    failed = [vcf_filename for vcf_filename, ok in zip(vcf_filenames, succeeded) if not ok]
+    if failed:
+        print(f"Failed to genotype {len(failed)} of {len(vcf_filenames)} samples: {', '.join(failed)}")
+        sys.exit(1)
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()